@@ -5,9 +5,9 @@ import time
 import dask.dataframe as dd
 import numpy as np
 import pandas as pd
-from dask.diagnostics import ProgressBar
 from concurrent.futures import ProcessPoolExecutor
-import sys
+from knn_neighbours import KNN_K, merge_topk, merge_column, topk_from_block, load_topk, save_topk
+from instrumentation import current, worker_stats
 
 # File paths (all stored under the "saved_matrices" folder)
 OUTPUT_FOLDER = "saved_matrices"
@@ -15,13 +15,17 @@ os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 MATRIX_FILE = os.path.join(OUTPUT_FOLDER, "braycurtis_matrix_columns.npy")
 FEATURE_NAMES_FILE = os.path.join(OUTPUT_FOLDER, "feature_names.txt")
 OLD_TABLE_FILE = os.path.join(OUTPUT_FOLDER, "old_asv_table.csv")
+# The new matrix is assembled here and renamed over MATRIX_FILE once complete.
+MATRIX_TMP_FILE = os.path.join(OUTPUT_FOLDER, "braycurtis_matrix_columns.tmp.npy")
 
 # A small epsilon to avoid division by zero
 EPSILON = 1e-12
 
-def update_progress(task, percent):
-    """Print progress messages and flush immediately."""
-    print(f"Progress Update: {task} - {percent}% complete", flush=True)
+# Worker processes per pool; inside a SLURM job this follows --cpus-per-task
+MAX_WORKERS = int(os.environ.get("SLURM_CPUS_PER_TASK", 54))
+
+# Rows/columns per tile when copying or mirroring matrix blocks
+MIRROR_BLOCK = 1024
 
 #############################
 # Parallel functions for new table internal distances
@@ -39,9 +43,11 @@ def init_worker_new(table, m):
 
 def compute_new_col(i):
     """Compute Bray–Curtis distances for new table’s column i vs. columns j > i.
-    Returns (i, result_vector) where result_vector is a NumPy array of length m_global.
+    Returns (i, result_vector, worker_stats) where result_vector[j - i - 1] is the distance to column j,
+    so each unordered pair is computed and sent back once.
     """
-    row_result = np.zeros(m_global, dtype=np.float64)
+    start = time.perf_counter()
+    row_result = np.zeros(m_global - i - 1, dtype=np.float64)
     x = new_table_global.iloc[:, i].values
     for j in range(i+1, m_global):
         y = new_table_global.iloc[:, j].values
@@ -51,8 +57,8 @@ def compute_new_col(i):
             d = 0.0
         else:
             d = np.sum(np.abs(x - y)) / denom
-        row_result[j] = d
-    return i, row_result
+        row_result[j - i - 1] = d
+    return i, row_result, worker_stats(start)
 
 #############################
 # Parallel functions for cross distances between new and old table
@@ -76,8 +82,9 @@ def init_worker_cross(old_table, new_table, m):
 
 def compute_cross(i):
     """For new table column i, compute Bray–Curtis distances to each old table column.
-    Returns (i, result_vector) of length n_old_global.
+    Returns (i, result_vector, worker_stats) with result_vector of length n_old_global.
     """
+    start = time.perf_counter()
     result = np.zeros(n_old_global, dtype=np.float64)
     x = new_table_global_cross.iloc[:, i].values
     for j in range(n_old_global):
@@ -88,120 +95,234 @@ def compute_cross(i):
         else:
             d = np.sum(np.abs(x - y)) / denom
         result[j] = d
-    return i, result
+    return i, result, worker_stats(start)
 
 #############################
-# Main function
+# Symmetric assembly
 #############################
-def main():
-    if len(sys.argv) != 2:
-        print("Usage: python append_braycurtis.py new_table.txt", flush=True)
-        sys.exit(1)
-    input_file = sys.argv[1]
 
-    # Load new table using Dask (features remain as columns)
-    update_progress("Loading new table with Dask", 0)
-    with ProgressBar():
+def mirror_upper(M, block=MIRROR_BLOCK):
+    """Copy the strict upper triangle of square M into its lower triangle, in place, tile by tile.
+    Always run: the saved matrix is a dense .npy that readers load whole, so both halves are stored.
+    """
+    n = M.shape[0]
+    for i0 in range(0, n, block):
+        i1 = min(i0 + block, n)
+        tile = M[i0:i1, i0:i1]
+        lower = np.tril_indices(i1 - i0, -1)
+        tile[lower] = tile.T[lower]
+        for j0 in range(i1, n, block):
+            j1 = min(j0 + block, n)
+            M[j0:j1, i0:i1] = M[i0:i1, j0:j1].T
+
+def copy_blocks(dst, src, transpose=False, block=MIRROR_BLOCK):
+    """dst[...] = src (or src.T), a band of rows at a time so src may be a memory map."""
+    rows = src.shape[0]
+    for r0 in range(0, rows, block):
+        r1 = min(r0 + block, rows)
+        if transpose:
+            dst[:, r0:r1] = src[r0:r1].T
+        else:
+            dst[r0:r1] = src[r0:r1]
+
+def merge_append(M_combined, existing_matrix, M_cross, M_new):
+    """Append-mode merge: fill the old and cross blocks of the combined matrix (the new
+    block M_new is already in place) and return the top-k table of the new samples.
+    """
+    n_old = existing_matrix.shape[0]
+    # Top-left: old matrix, already symmetric with a zero diagonal.
+    copy_blocks(M_combined[:n_old, :n_old], existing_matrix)
+    # Top-right: cross matrix. Bottom-left: its transpose.
+    copy_blocks(M_combined[:n_old, n_old:], M_cross)
+    copy_blocks(M_combined[n_old:, :n_old], M_cross, transpose=True)
+    # Neighbours of new samples come from the cross block and the new internal block.
+    new_knn = topk_from_block(M_cross.T, col_offset=0)
+    return merge_topk(*new_knn, *topk_from_block(M_new, col_offset=n_old, self_offset=n_old))
+
+def open_matrix_output(n):
+    """Zero-filled n x n float64 matrix backed by MATRIX_TMP_FILE."""
+    return np.lib.format.open_memmap(MATRIX_TMP_FILE, mode="w+", dtype=np.float64, shape=(n, n))
+
+def commit_matrix_output(M):
+    """Flush the assembled matrix and move it over MATRIX_FILE."""
+    M.flush()
+    os.replace(MATRIX_TMP_FILE, MATRIX_FILE)
+
+def discard_matrix_output():
+    """Remove a partly assembled MATRIX_TMP_FILE after a failed run."""
+    if os.path.exists(MATRIX_TMP_FILE):
+        os.remove(MATRIX_TMP_FILE)
+
+#############################
+# Distance phases
+#############################
+
+def compute_internal(new_table, workers=MAX_WORKERS, out=None):
+    """Bray–Curtis matrix (m x m) among the columns of new_table, computed in parallel.
+    Each pair is computed once into the upper triangle, which is then mirrored into
+    the lower triangle. If out is given
+    (e.g. a block of the combined matrix) the result is written there.
+    """
+    m = new_table.shape[1]
+    instr = current()
+    progress = instr.progress("internal distances", m, unit="features", work_total=m * (m - 1) // 2,
+                              workers=min(workers, m))
+    M_new = np.zeros((m, m), dtype=np.float64) if out is None else out
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_new, initargs=(new_table, m)) as executor:
+        for i, row_result, stats in executor.map(compute_new_col, range(m)):
+            M_new[i, i+1:] = row_result
+            instr.worker(stats)
+            progress.update(work=m - 1 - i)
+    mirror_upper(M_new)
+    np.fill_diagonal(M_new, 0)
+    return M_new
+
+def compute_cross_block(old_table, new_table, workers=MAX_WORKERS, on_column=None):
+    """Bray–Curtis distances (n_old x m) between every old and every new column.
+    on_column(i, cross_result) is called as each new column's distances arrive.
+    """
+    n_old = old_table.shape[1]
+    m = new_table.shape[1]
+    instr = current()
+    progress = instr.progress("cross distances", m, unit="features", work_total=n_old * m,
+                              workers=min(workers, m))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_cross, initargs=(old_table, new_table, m)) as executor:
+        M_cross = np.zeros((n_old, m), dtype=np.float64)
+        for i, cross_result, stats in executor.map(compute_cross, range(m)):
+            M_cross[:, i] = cross_result
+            if on_column is not None:
+                on_column(i, cross_result)
+            instr.worker(stats)
+            progress.update(work=n_old)
+    return M_cross
+
+def cross_neighbour_merger(old_knn_idx, old_knn_dist):
+    """on_column callback for compute_cross_block that offers each new sample to the old
+    samples' top-k table, updating it in place.
+    """
+    n_old = old_knn_idx.shape[0]
+    def merge_cross_neighbours(i, cross_result):
+        # New sample n_old + i is a neighbour candidate for every old sample.
+        merge_column(old_knn_idx, old_knn_dist, n_old + i, cross_result)
+    return merge_cross_neighbours
+
+#############################
+# Loading
+#############################
+
+def load_new_table(input_file):
+    """Load a tab-separated count table with Dask (features remain as columns).
+    The first column is used as index and columns containing NaN are dropped.
+    """
+    instr = current()
+    with instr.dask_progress():
         new_ddf = dd.read_csv(input_file, sep="\t", assume_missing=True, sample=10_000_000)
         new_ddf = new_ddf.persist()
     # Use first column as index.
     new_ddf = new_ddf.set_index(new_ddf.columns[0])
     new_ddf = new_ddf.map_partitions(lambda df: df.apply(pd.to_numeric, errors="coerce"))
-    with ProgressBar():
+    with instr.dask_progress():
         non_nan = new_ddf.isnull().sum().compute() == 0
     good_cols = non_nan[non_nan].index.tolist()
     new_ddf = new_ddf[good_cols]
-    update_progress("Dropped NaN columns in new table", 10)
-    with ProgressBar():
+    print(f"Kept {len(good_cols)} of {len(non_nan)} columns without NaN.", flush=True)
+    with instr.dask_progress():
         new_table = new_ddf.compute()
-    update_progress("New table computed", 20)
-    # We compare columns, so do not transpose.
-    new_features = list(new_table.columns)
-    m = len(new_features)
-    update_progress("New table ready", 30)
-    print("New features:", new_features, flush=True)
-
-    # Check if an old table already exists.
-    if os.path.exists(OLD_TABLE_FILE) and os.path.exists(FEATURE_NAMES_FILE) and os.path.exists(MATRIX_FILE):
-        print("Old table exists. Entering append mode.", flush=True)
-        old_table = pd.read_csv(OLD_TABLE_FILE, index_col=0)
-        old_features = list(old_table.columns)
-        n_old = len(old_features)
-        print(f"Loaded old table with {n_old} features.", flush=True)
-        # Load the existing BC matrix.
-        existing_matrix = np.load(MATRIX_FILE)
-    else:
+    return new_table
+
+#############################
+# Main function
+#############################
+def run(input_file, instr):
+    with instr.phase("load"):
+        new_table = load_new_table(input_file)
+        # We compare columns, so do not transpose.
+        new_features = list(new_table.columns)
+        m = len(new_features)
+        print(f"New table ready with {m} features.", flush=True)
+
+        # Check if an old table already exists.
+        append_mode = os.path.exists(OLD_TABLE_FILE) and os.path.exists(FEATURE_NAMES_FILE) and os.path.exists(MATRIX_FILE)
+        if append_mode:
+            print("Old table exists. Entering append mode.", flush=True)
+            old_table = pd.read_csv(OLD_TABLE_FILE, index_col=0)
+            old_features = list(old_table.columns)
+            n_old = len(old_features)
+            print(f"Loaded old table with {n_old} features.", flush=True)
+            # Map the existing BC matrix; it is only read in blocks.
+            existing_matrix = np.load(MATRIX_FILE, mmap_mode="r")
+            # Load the neighbour table, rebuilding it from the matrix if missing or stale.
+            knn = load_topk()
+            if knn is None or knn[0].shape != (n_old, KNN_K):
+                print("Building neighbour table from the existing BC matrix.", flush=True)
+                knn = topk_from_block(existing_matrix, col_offset=0, self_offset=0)
+            old_knn_idx, old_knn_dist = knn
+
+    if not append_mode:
         print("No old table found. This run will create the initial BC matrix.", flush=True)
         # Compute BC matrix for new table only (internal comparisons)
-        with ProcessPoolExecutor(max_workers=54, initializer=init_worker_new, initargs=(new_table, m)) as executor:
-            M_new = np.zeros((m, m), dtype=np.float64)
-            for i, row_result in executor.map(compute_new_col, range(m)):
-                M_new[i, :] = row_result
-                for j in range(i+1, m):
-                    M_new[j, i] = row_result[j]
-                update_progress(f"Processed new feature {i+1} of {m}", int((i+1)/m*100))
-        # Force symmetry and set diagonal to zero
-        M_new = (M_new + M_new.T) / 2
-        np.fill_diagonal(M_new, 0)
-        # Save as the new BC matrix.
-        np.save(MATRIX_FILE, M_new)
-        with open(FEATURE_NAMES_FILE, "w") as f:
-            for feat in new_features:
-                f.write(feat + "\n")
-        # Save new_table as old_table for future appends.
-        new_table.to_csv(OLD_TABLE_FILE)
+        with instr.phase("compute internal"):
+            M_new = compute_internal(new_table, out=open_matrix_output(m))
+        with instr.phase("save"):
+            # Save the top-k neighbour table, then move the new BC matrix into place.
+            save_topk(*topk_from_block(M_new, col_offset=0, self_offset=0))
+            commit_matrix_output(M_new)
+            with open(FEATURE_NAMES_FILE, "w") as f:
+                for feat in new_features:
+                    f.write(feat + "\n")
+            # Save new_table as old_table for future appends.
+            new_table.to_csv(OLD_TABLE_FILE)
         print("Initial BC matrix computed and saved.", flush=True)
-        update_progress("All tasks complete", 100)
         return
 
     # === Append mode ===
+    # The combined matrix is written once, block by block:
+    #   [ existing (n_old x n_old) | cross (n_old x m) ]
+    #   [ cross.T  (m x n_old)     | new   (m x m)     ]
+    new_n = n_old + m
+    M_combined = open_matrix_output(new_n)
+
     # Compute internal distances among new table’s features (parallelized)
-    with ProcessPoolExecutor(max_workers=54, initializer=init_worker_new, initargs=(new_table, m)) as executor:
-        M_new = np.zeros((m, m), dtype=np.float64)
-        for i, row_result in executor.map(compute_new_col, range(m)):
-            M_new[i, :] = row_result
-            for j in range(i+1, m):
-                M_new[j, i] = row_result[j]
-            update_progress(f"Processed new feature {i+1} of {m}", int((i+1)/m*100))
-    # Force symmetry for new internal matrix:
-    M_new = (M_new + M_new.T) / 2
-    np.fill_diagonal(M_new, 0)
+    # straight into the bottom-right block.
+    with instr.phase("compute internal"):
+        M_new = compute_internal(new_table, out=M_combined[n_old:, n_old:])
 
     # Compute cross distances: for each new feature vs. each old feature.
-    with ProcessPoolExecutor(max_workers=54, initializer=init_worker_cross, initargs=(old_table, new_table, m)) as executor:
-        M_cross = np.zeros((n_old, m), dtype=np.float64)
-        for i, cross_result in executor.map(compute_cross, range(m)):
-            M_cross[:, i] = cross_result
-            update_progress(f"Processed cross distance for new feature {i+1} of {m}", int((i+1)/m*100))
-    # Combine existing BC matrix (shape n_old x n_old), new internal matrix (m x m),
-    # and cross distances (n_old x m) into a new matrix.
-    new_n = n_old + m
-    M_combined = np.zeros((new_n, new_n), dtype=np.float64)
-    # Top-left: old matrix.
-    M_combined[:n_old, :n_old] = existing_matrix
-    # Top-right: cross matrix.
-    M_combined[:n_old, n_old:] = M_cross
-    # Bottom-left: transpose of cross.
-    M_combined[n_old:, :n_old] = M_cross.T
-    # Bottom-right: new internal distances.
-    M_combined[n_old:, n_old:] = M_new
-    # Force symmetry on the combined matrix and set diagonal to zero.
-    M_combined = (M_combined + M_combined.T) / 2
-    np.fill_diagonal(M_combined, 0)
-
-    # Save combined BC matrix.
-    np.save(MATRIX_FILE, M_combined)
-    # Update feature names.
-    combined_features = old_features + new_features
-    with open(FEATURE_NAMES_FILE, "w") as f:
-        for feat in combined_features:
-            f.write(feat + "\n")
-    # Also update the old table by concatenating the old and new tables (by columns).
-    combined_table = pd.concat([old_table, new_table], axis=1)
-    combined_table.to_csv(OLD_TABLE_FILE)
+    with instr.phase("compute cross"):
+        M_cross = compute_cross_block(old_table, new_table,
+                                      on_column=cross_neighbour_merger(old_knn_idx, old_knn_dist))
+
+    with instr.phase("merge"):
+        new_knn = merge_append(M_combined, existing_matrix, M_cross, M_new)
+        del existing_matrix
+
+    with instr.phase("save"):
+        # Move the combined BC matrix into place.
+        commit_matrix_output(M_combined)
+        # Update feature names.
+        combined_features = old_features + new_features
+        with open(FEATURE_NAMES_FILE, "w") as f:
+            for feat in combined_features:
+                f.write(feat + "\n")
+        # Also update the old table by concatenating the old and new tables (by columns).
+        combined_table = pd.concat([old_table, new_table], axis=1)
+        combined_table.to_csv(OLD_TABLE_FILE)
+        save_topk(np.vstack([old_knn_idx, new_knn[0]]), np.vstack([old_knn_dist, new_knn[1]]))
     print("BC matrix updated with new table. Combined matrix saved.", flush=True)
-    update_progress("All tasks complete", 100)
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: python append_braycurtis.py new_table.txt", flush=True)
+        sys.exit(1)
+    instr = current()
+    try:
+        run(sys.argv[1], instr)
+    except BaseException:
+        # Do not leave a partly assembled matrix behind; MATRIX_FILE is untouched until commit.
+        discard_matrix_output()
+        raise
+    finally:
+        instr.close()
 
 if __name__ == '__main__':
     main()
-
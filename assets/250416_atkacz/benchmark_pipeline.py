@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+import numpy as np
+import pandas as pd
+import append_braycurtis3 as engine
+from append_braycurtis3 import load_new_table, compute_internal, compute_cross_block
+from knn_neighbours import topk_from_block
+from instrumentation import rss_mb, pss_mb
+
+# PCoA and plotting are optional; their phases are skipped when the packages are missing.
+try:
+    from skbio.stats.ordination import pcoa
+except ImportError:
+    pcoa = None
+try:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+except ImportError:
+    plt = sns = None
+
+RESULTS_FILE = "benchmark_results.jsonl"
+
+# A phase slower than the previous run of the same configuration by this factor is flagged.
+# Timings are compared by their minimum over the repeats; phases whose minimum stays
+# under MIN_COMPARE_SECONDS in both runs are too short to compare reliably.
+# Memory is compared the same way, ignoring phases that use under MIN_COMPARE_MB.
+REGRESSION_THRESHOLD = 1.2
+MIN_COMPARE_SECONDS = 0.5
+MIN_COMPARE_MB = 50
+
+# Seconds between memory samples while a phase runs
+SAMPLE_INTERVAL = 0.05
+
+#############################
+# Synthetic ASV tables
+#############################
+
+def generate_table(n_features, n_samples, seed=0, prevalence=(0.3, 6.0), dispersion=2.0, depth=50_000):
+    """Seeded, sparse and overdispersed ASV count table (ASVs as rows, samples as columns).
+    Each ASV gets a log-normal mean abundance and a Beta-distributed prevalence, so most
+    ASVs are rare. Counts are gamma-Poisson (negative binomial) with the given dispersion,
+    scaled to a log-normal sequencing depth per sample.
+    """
+    rng = np.random.default_rng(seed)
+    abundance = rng.lognormal(mean=0.0, sigma=2.0, size=n_features)
+    abundance /= abundance.sum()
+    present_p = rng.beta(*prevalence, size=n_features)
+    present = rng.random((n_features, n_samples)) < present_p[:, None]
+    depths = rng.lognormal(mean=np.log(depth), sigma=0.5, size=n_samples)
+    mean = abundance[:, None] * depths[None, :] / np.maximum(present_p, 1e-3)[:, None]
+    lam = rng.gamma(shape=1.0 / dispersion, scale=mean * dispersion) * present
+    counts = rng.poisson(lam)
+    index = pd.Index([f"ASV_{f+1}" for f in range(n_features)], name="#NAME")
+    columns = [f"SYN{seed}_{s+1}" for s in range(n_samples)]
+    return pd.DataFrame(counts, index=index, columns=columns)
+
+#############################
+# Measurement
+#############################
+
+def current_rss_mb():
+    """Current (not peak) resident memory of this process in MB, or None without /proc."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+def child_pids():
+    """Pids of this process's live children (the worker pools), where /proc lists them."""
+    pids = []
+    try:
+        for task in os.listdir("/proc/self/task"):
+            with open(f"/proc/self/task/{task}/children", "r") as f:
+                pids += f.read().split()
+    except OSError:
+        pass
+    return pids
+
+class PhaseMemory:
+    """Samples memory in a background thread while one phase runs. ru_maxrss is a lifetime
+    high-water mark, so after the first large phase it shows nothing about later ones.
+    rss_increase_mb is the main process's peak current RSS above its value at the start;
+    workers_peak_mb is the largest summed PSS of the worker processes seen in a sample.
+    Without /proc only the growth of the main process's high-water mark is available.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.read_main = current_rss_mb if current_rss_mb() is not None else rss_mb
+        self.workers_peak = 0.0
+        self.done = threading.Event()
+
+    def sample(self):
+        self.main_peak = max(self.main_peak, self.read_main())
+        self.workers_peak = max(self.workers_peak, sum(pss_mb(pid) or 0.0 for pid in child_pids()))
+
+    def watch(self):
+        while not self.done.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.start = self.main_peak = self.read_main()
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+        self.sample()
+
+    def result(self):
+        return {"rss_increase_mb": self.main_peak - self.start, "workers_peak_mb": self.workers_peak}
+
+def measure(func, *args, **kwargs):
+    """Run func once and return (result, seconds, PhaseMemory.result())."""
+    with PhaseMemory() as memory:
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+    return result, seconds, memory.result()
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#############################
+# Pipeline phases
+#############################
+
+def run_pcoa(matrix):
+    """Same call as pcoa_with_metadata_quick_work.py."""
+    results = pcoa(matrix)
+    return results.samples.iloc[:, :2].to_numpy()
+
+def run_plot(coords, path):
+    fig, ax = plt.subplots(figsize=(10, 8))
+    sns.scatterplot(x=coords[:, 0], y=coords[:, 1], s=100, edgecolor="black", ax=ax)
+    fig.savefig(path, dpi=100, bbox_inches="tight")
+    plt.close(fig)
+
+def build_matrix(table, workers):
+    """The initial-build path of append_braycurtis3.run: internal distances straight into
+    the memory-mapped output matrix.
+    """
+    return compute_internal(table, workers, out=engine.open_matrix_output(table.shape[1]))
+
+def merge_and_commit(M_combined, existing_matrix, M_cross, M_new):
+    """append_braycurtis3.run's merge phase, then the combined matrix is moved into place."""
+    engine.merge_append(M_combined, existing_matrix, M_cross, M_new)
+    engine.commit_matrix_output(M_combined)
+
+def benchmark_once(table_file, workers, n_old, workdir):
+    """Time every pipeline phase once in the current (fresh) process, started in workdir.
+    The first n_old samples play the existing matrix and the rest the appended table.
+    Returns {phase: {"seconds", "rss_increase_mb", "workers_peak_mb"[, "skipped"]}}.
+    """
+    phases = {}
+
+    def record(phase, seconds, memory=None, skipped=None):
+        phases[phase] = {"seconds": seconds, **(memory or {})}
+        if skipped is not None:
+            phases[phase]["skipped"] = skipped
+
+    table, seconds, memory = measure(load_new_table, table_file)
+    record("load", seconds, memory)
+    n = table.shape[1]
+
+    M, seconds, memory = measure(build_matrix, table, workers)
+    record("internal", seconds, memory)
+    engine.commit_matrix_output(M)
+    del M
+    matrix = np.load(engine.MATRIX_FILE)
+
+    if n_old > 0:
+        # Append mode as in append_braycurtis3.run: an existing memory-mapped matrix and
+        # its neighbour table, cross distances with the per-column neighbour merge, then
+        # the merge into a new memory-mapped matrix.
+        old_table, new_table = table.iloc[:, :n_old], table.iloc[:, n_old:]
+        existing_file = os.path.join(workdir, "existing_matrix.npy")
+        np.save(existing_file, matrix[:n_old, :n_old])
+        existing_matrix = np.load(existing_file, mmap_mode="r")
+        old_knn = topk_from_block(existing_matrix, col_offset=0, self_offset=0)
+        M_cross, seconds, memory = measure(compute_cross_block, old_table, new_table, workers,
+                                           on_column=engine.cross_neighbour_merger(*old_knn))
+        record("cross", seconds, memory)
+        M_combined = engine.open_matrix_output(n)
+        M_combined[n_old:, n_old:] = matrix[n_old:, n_old:]
+        _, seconds, memory = measure(merge_and_commit, M_combined, existing_matrix, M_cross,
+                                     M_combined[n_old:, n_old:])
+        record("merge", seconds, memory)
+
+    if pcoa is None:
+        record("pcoa", None, skipped="scikit-bio not installed")
+        return phases
+    coords, seconds, memory = measure(run_pcoa, matrix)
+    record("pcoa", seconds, memory)
+
+    if plt is None:
+        record("plot", None, skipped="matplotlib/seaborn not installed")
+        return phases
+    _, seconds, memory = measure(run_plot, coords, os.path.join(workdir, "pcoa_plot.png"))
+    record("plot", seconds, memory)
+    return phases
+
+def run_in_subprocess(table_file, workers, n_old, workdir):
+    """Run benchmark_once in a fresh interpreter so memory high-water marks start from zero.
+    It starts in workdir, where append_braycurtis3 puts its saved_matrices output folder.
+    """
+    output = os.path.join(workdir, "phases.json")
+    command = [sys.executable, os.path.abspath(__file__), "_once", table_file,
+               "--workers", str(workers), "--old-samples", str(n_old),
+               "--workdir", workdir, "--output", output]
+    # Instrumentation off: its progress lines and timers are not part of the measured pipeline.
+    env = {**os.environ, "BC_INSTRUMENT": "off"}
+    subprocess.run(command, env=env, cwd=workdir, check=True, stdout=subprocess.DEVNULL)
+    with open(output, "r") as f:
+        return json.load(f)
+
+def benchmark_config(n_features, n_samples, workers, append_fraction, seed, repeat, workdir):
+    """Time every pipeline phase for one table size and worker count: one warm-up run, then
+    repeat measured runs, each in a fresh process. Returns one record per phase.
+    """
+    table_file = os.path.join(workdir, f"syn_{n_features}x{n_samples}_{seed}.txt")
+    if not os.path.exists(table_file):
+        generate_table(n_features, n_samples, seed).to_csv(table_file, sep="\t")
+    n_new = max(1, int(round(n_samples * append_fraction)))
+    n_old = n_samples - n_new
+    config = {"features": n_features, "samples": n_samples, "workers": workers,
+              "old_samples": n_old, "new_samples": n_new, "seed": seed}
+    pairs = {"internal": n_samples * (n_samples - 1) // 2, "cross": n_old * n_new}
+
+    run_dir = os.path.join(workdir, f"run_{n_features}x{n_samples}_{workers}")
+    os.makedirs(run_dir, exist_ok=True)
+    run_in_subprocess(table_file, workers, n_old, run_dir)
+    runs = [run_in_subprocess(table_file, workers, n_old, run_dir) for _ in range(repeat)]
+
+    records = []
+    for phase, first in runs[0].items():
+        rec = {"phase": phase, **config, "repeats": repeat}
+        if "skipped" in first:
+            rec.update(seconds=None, skipped=first["skipped"])
+            print(f"  {phase:<10} skipped ({first['skipped']})", flush=True)
+            records.append(rec)
+            continue
+        samples = [r[phase]["seconds"] for r in runs]
+        rec.update(seconds=statistics.median(samples), seconds_min=min(samples), seconds_all=samples,
+                   rss_increase_mb=max(r[phase]["rss_increase_mb"] for r in runs),
+                   workers_peak_mb=max(r[phase]["workers_peak_mb"] for r in runs),
+                   memory_mb=max(r[phase]["rss_increase_mb"] + r[phase]["workers_peak_mb"] for r in runs))
+        if phase in pairs:
+            rec["pairs"] = pairs[phase]
+            rec["pairs_per_second"] = pairs[phase] / rec["seconds_min"] if rec["seconds_min"] > 0 else None
+        records.append(rec)
+        print(f"  {phase:<10} min {rec['seconds_min']:.3f} s, median {rec['seconds']:.3f} s, "
+              f"main +{rec['rss_increase_mb']:.0f} MB, workers {rec['workers_peak_mb']:.0f} MB", flush=True)
+    return records
+
+#############################
+# Results
+#############################
+
+def load_previous(results_file):
+    """Return {(phase, config...): record} holding the latest earlier result of each configuration."""
+    if not os.path.exists(results_file):
+        return {}
+    with open(results_file, "r") as f:
+        return {result_key(rec): rec for rec in map(json.loads, filter(str.strip, f))}
+
+def result_key(rec):
+    return (rec["phase"], rec["features"], rec["samples"], rec["workers"], rec["new_samples"], rec["seed"])
+
+def compare(records, previous):
+    """Print phases whose minimum time got slower, or whose memory (main process increase
+    plus workers) grew, by more than REGRESSION_THRESHOLD against the previous run.
+    Phases under MIN_COMPARE_SECONDS or MIN_COMPARE_MB in both runs are not compared.
+    """
+    compared = worse = 0
+    for rec in records:
+        old = previous.get(result_key(rec))
+        if not old or not old.get("seconds") or not rec.get("seconds"):
+            continue
+        name = f"{rec['phase']} {rec['features']}x{rec['samples']} workers={rec['workers']}"
+        # Results from before --repeat only have a single "seconds" sample.
+        old_seconds = old.get("seconds_min", old["seconds"])
+        new_seconds = rec["seconds_min"]
+        if max(old_seconds, new_seconds) >= MIN_COMPARE_SECONDS:
+            compared += 1
+            ratio = new_seconds / old_seconds
+            if ratio > REGRESSION_THRESHOLD:
+                worse += 1
+                print(f"SLOWER: {name}: {old_seconds:.3f} s -> {new_seconds:.3f} s "
+                      f"({ratio:.2f}x, run {old['run_id']})", flush=True)
+        # Results from before per-phase memory sampling have no "memory_mb".
+        old_mb = old.get("memory_mb")
+        new_mb = rec["memory_mb"]
+        if old_mb is not None and max(old_mb, new_mb) >= MIN_COMPARE_MB:
+            compared += 1
+            ratio = new_mb / max(old_mb, 1e-9)
+            if ratio > REGRESSION_THRESHOLD:
+                worse += 1
+                print(f"MORE MEMORY: {name}: {old_mb:.0f} MB -> {new_mb:.0f} MB "
+                      f"({ratio:.2f}x, run {old['run_id']})", flush=True)
+    if compared and not worse:
+        print(f"No phase slower or larger than its previous run ({compared} compared).", flush=True)
+
+#############################
+# Main function
+#############################
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark load -> distances -> PCoA -> plot on synthetic ASV tables.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="write one synthetic ASV table")
+    gen.add_argument("output")
+    gen.add_argument("--features", type=int, default=20_000)
+    gen.add_argument("--samples", type=int, default=100)
+    gen.add_argument("--seed", type=int, default=0)
+
+    run = sub.add_parser("run", help="time the pipeline across table sizes and worker counts")
+    run.add_argument("--features", type=int, nargs="+", default=[5_000])
+    run.add_argument("--samples", type=int, nargs="+", default=[20, 80])
+    run.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    run.add_argument("--append-fraction", type=float, default=0.25,
+                     help="share of samples treated as the appended table in the cross phase")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--repeat", type=int, default=3,
+                     help="measured runs per configuration, after one warm-up run (default 3)")
+    run.add_argument("--results", default=RESULTS_FILE, help=f"JSON-lines results file (default {RESULTS_FILE})")
+    # Internal: one measured run of one configuration, started by run_in_subprocess.
+    once = sub.add_parser("_once")
+    once.add_argument("table")
+    once.add_argument("--workers", type=int, required=True)
+    once.add_argument("--old-samples", type=int, required=True)
+    once.add_argument("--workdir", required=True)
+    once.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    if args.command == "_once":
+        phases = benchmark_once(args.table, args.workers, args.old_samples, args.workdir)
+        with open(args.output, "w") as f:
+            json.dump(phases, f)
+        return
+
+    if args.command == "generate":
+        generate_table(args.features, args.samples, args.seed).to_csv(args.output, sep="\t")
+        print(f"Synthetic table ({args.features} ASVs x {args.samples} samples) saved to {args.output}.", flush=True)
+        return
+
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    previous = load_previous(args.results)
+    run_info = {"run_id": time.strftime("%Y%m%dT%H%M%S"), "commit": git_commit(),
+                "host": platform.node(), "python": platform.python_version(),
+                "numpy": np.__version__, "cpus": os.cpu_count()}
+    records = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_features in args.features:
+            for n_samples in args.samples:
+                for workers in args.workers:
+                    print(f"{n_features} ASVs x {n_samples} samples, {workers} workers", flush=True)
+                    records += benchmark_config(n_features, n_samples, workers,
+                                                args.append_fraction, args.seed, args.repeat, workdir)
+    with open(args.results, "a") as f:
+        for rec in records:
+            f.write(json.dumps({**run_info, **rec}) + "\n")
+    print(f"{len(records)} results appended to {args.results}.", flush=True)
+    compare(records, previous)
+
+if __name__ == '__main__':
+    main()
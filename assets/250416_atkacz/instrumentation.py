@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import math
+import time
+import resource
+from contextlib import contextmanager, nullcontext
+
+# Configuration comes from the environment so it can be set in a SLURM script:
+#   BC_INSTRUMENT=off         disable progress, timers and metrics (no-op mode)
+#   BC_PROGRESS_INTERVAL=30   seconds between progress lines (default 10)
+#   BC_METRICS=run.jsonl      also append every event as a JSON line to this file
+PROGRESS_INTERVAL = 10.0
+
+def enabled():
+    return os.environ.get("BC_INSTRUMENT", "on").lower() not in ("off", "0", "false", "no")
+
+def rss_mb(who=resource.RUSAGE_SELF):
+    """Peak resident memory in MB (ru_maxrss is KB on Linux, bytes on macOS)."""
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(who).ru_maxrss / scale
+
+def format_seconds(seconds):
+    if seconds is None or not math.isfinite(seconds):
+        return "?"
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+#############################
+# Worker-side timing
+#############################
+
+def pss_mb(pid="self"):
+    """Proportional set size of a process in MB, or None where /proc/<pid>/smaps_rollup
+    is unavailable. Unlike RSS, pages shared with the parent and other forked workers are
+    divided between them, so PSS of concurrent workers can be summed.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def worker_stats(start):
+    """Called at the end of a pool task started at time.perf_counter() == start.
+    Returns (pid, seconds, peak RSS MB, PSS MB or None) for the parent's Instrumentation.worker().
+    """
+    seconds = time.perf_counter() - start
+    return os.getpid(), seconds, rss_mb(), pss_mb() if enabled() else None
+
+#############################
+# Progress
+#############################
+
+class Progress:
+    """Rate-limited progress for one loop, with throughput, work rate (e.g. pairs/s) and ETA."""
+
+    def __init__(self, instr, task, total, unit="items", work_total=None, work_unit="pairs"):
+        self.instr = instr
+        self.task = task
+        self.total = total
+        self.unit = unit
+        self.work_total = work_total
+        self.work_unit = work_unit
+        self.done = 0
+        self.work = 0
+        self.start = self.last = time.monotonic()
+
+    def update(self, n=1, work=0):
+        self.done += n
+        self.work += work
+        now = time.monotonic()
+        if now - self.last >= self.instr.interval or self.done >= self.total:
+            self.last = now
+            self.report(now)
+
+    def report(self, now):
+        elapsed = max(now - self.start, 1e-9)
+        rate = self.done / elapsed
+        if self.work_total:
+            eta = (self.work_total - self.work) / (self.work / elapsed) if self.work else None
+        else:
+            eta = (self.total - self.done) / rate if rate else None
+        percent = int(self.done / self.total * 100) if self.total else 100
+        line = f"Progress: {self.task} {self.done:.0f}/{self.total:.0f} {self.unit} ({percent}%) | {rate:.1f} {self.unit}/s"
+        if self.work:
+            line += f" | {self.work / elapsed:,.0f} {self.work_unit}/s"
+        line += f" | elapsed {format_seconds(elapsed)} | ETA {format_seconds(eta)}"
+        print(line, flush=True)
+        self.instr.event("progress", task=self.task, done=self.done, total=self.total, unit=self.unit,
+                         work=self.work, work_unit=self.work_unit, elapsed=elapsed, eta=eta)
+
+class NullProgress:
+    def update(self, n=1, work=0):
+        pass
+
+#############################
+# Instrumentation
+#############################
+
+class Instrumentation:
+    """Per-phase timers, rate-limited progress, worker statistics and peak memory.
+    Events are printed and, if metrics_file is set, appended as JSON lines.
+    """
+
+    def __init__(self, metrics_file=None, interval=PROGRESS_INTERVAL):
+        self.interval = interval
+        self.metrics = open(metrics_file, "a") if metrics_file else None
+        # (name, seconds, pool size or None, failed)
+        self.phases = []
+        # pid -> (tasks, busy seconds, peak RSS MB, peak PSS MB or None)
+        self.workers = {}
+        # Pool size declared and pids seen in the running phase, and the largest
+        # sum of worker PSS over any phase
+        self.pool_size = None
+        self.phase_pss = {}
+        self.peak_pool_pss = 0.0
+        self.start = time.perf_counter()
+        self.event("start", argv=sys.argv, pid=os.getpid(), cpus=os.cpu_count(),
+                   slurm_job=os.environ.get("SLURM_JOB_ID"))
+
+    def event(self, kind, **fields):
+        if self.metrics is not None:
+            self.metrics.write(json.dumps({"event": kind, "time": time.time(), **fields}) + "\n")
+            self.metrics.flush()
+
+    @contextmanager
+    def phase(self, name):
+        """Time a pipeline phase (load, compute, merge, save, ...). A phase that raises is
+        still recorded, marked as failed.
+        """
+        start = time.perf_counter()
+        self.pool_size = None
+        self.phase_pss = {}
+        print(f"Phase {name}: started", flush=True)
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            seconds = time.perf_counter() - start
+            pool = None
+            if self.pool_size:
+                # A pool only starts as many processes as it has tasks.
+                pool = min(self.pool_size, len(self.phase_pss)) if self.phase_pss else self.pool_size
+            self.phases.append((name, seconds, pool, failed))
+            self.peak_pool_pss = max(self.peak_pool_pss, sum(v for v in self.phase_pss.values() if v))
+            status = "failed after " if failed else ""
+            print(f"Phase {name}: {status}{format_seconds(seconds)} ({seconds:.2f} s), peak RSS {rss_mb():.0f} MB",
+                  flush=True)
+            self.event("phase", name=name, seconds=seconds, failed=failed, workers=pool, peak_rss_mb=rss_mb(),
+                       peak_rss_children_mb=rss_mb(resource.RUSAGE_CHILDREN))
+
+    def progress(self, task, total, unit="items", work_total=None, work_unit="pairs", workers=None):
+        """Progress for one loop; workers is the size of the process pool running it, if any."""
+        if workers:
+            self.pool_size = max(self.pool_size or 0, workers)
+        return Progress(self, task, total, unit, work_total, work_unit)
+
+    def dask_progress(self):
+        """Progress bar for dask computations. It redraws in place, so it is only shown on a
+        terminal; in batch logs the phase timers and Progress lines report instead.
+        """
+        if not sys.stdout.isatty():
+            return nullcontext()
+        from dask.diagnostics import ProgressBar
+        return ProgressBar(minimum=1.0, dt=1.0)
+
+    def worker(self, stats):
+        """Record one task's (pid, seconds, peak RSS MB, PSS MB) as returned by worker_stats."""
+        pid, seconds, peak, pss = stats
+        tasks, busy, worker_peak, worker_pss = self.workers.get(pid, (0, 0.0, 0.0, None))
+        if pss is not None:
+            worker_pss = max(worker_pss or 0.0, pss)
+            self.phase_pss[pid] = max(self.phase_pss.get(pid, 0.0), pss)
+        else:
+            self.phase_pss.setdefault(pid, None)
+        self.workers[pid] = (tasks + 1, busy + seconds, max(worker_peak, peak), worker_pss)
+
+    def close(self):
+        """Print and record the run summary, including figures for sizing SLURM requests."""
+        wall = time.perf_counter() - self.start
+        main_peak = rss_mb()
+        busy = sum(b for _, b, _, _ in self.workers.values())
+        pools = [pool for _, _, pool, _ in self.phases if pool]
+        max_pool = max(pools, default=0)
+        # Largest single worker; its RSS also counts pages shared with the main process.
+        worker_peak = rss_mb(resource.RUSAGE_CHILDREN)
+        width = max([len(name) for name, *_ in self.phases] + [5])
+        print("Run summary:", flush=True)
+        for name, seconds, pool, failed in self.phases:
+            notes = (f"  {pool} workers" if pool else "") + ("  FAILED" if failed else "")
+            print(f"  {name:<{width}} {seconds:10.2f} s{notes}", flush=True)
+        print(f"  {'total':<{width}} {wall:10.2f} s", flush=True)
+        print(f"  peak RSS: main {main_peak:.0f} MB, largest worker {worker_peak:.0f} MB", flush=True)
+        if self.workers:
+            # Worker-seconds available while pools were running
+            capacity = sum(seconds * pool for _, seconds, pool, _ in self.phases if pool)
+            utilisation = busy / capacity if capacity else 0.0
+            print(f"  at most {max_pool} concurrent workers, {busy:.2f} s busy in total, "
+                  f"utilisation {utilisation:.0%} of pool time", flush=True)
+            for pid, (tasks, b, peak, pss) in sorted(self.workers.items()):
+                self.event("worker", pid=pid, tasks=tasks, busy_seconds=b, peak_rss_mb=peak, peak_pss_mb=pss)
+        have_pss = all(pss is not None for *_, pss in self.workers.values())
+        request = f"--cpus-per-task={max(1, max_pool)}"
+        if have_pss:
+            # Main peak plus the workers' summed PSS, which splits shared pages between them.
+            # PSS is sampled at the end of each task, so a margin is added.
+            estimate = main_peak + self.peak_pool_pss
+            request += f" --mem={max(1, math.ceil(estimate * 1.25 / 1024))}G"
+            print(f"  memory estimate: {estimate:.0f} MB (main peak + worker PSS)", flush=True)
+        else:
+            print("  no --mem suggestion: worker PSS is unavailable on this system", flush=True)
+        print(f"  suggested SLURM request: {request}", flush=True)
+        self.event("summary", wall_seconds=wall, phases={name: seconds for name, seconds, _, _ in self.phases},
+                   failed=[name for name, _, _, failed in self.phases if failed], peak_rss_mb=main_peak,
+                   worker_peak_rss_mb=worker_peak, worker_pss_mb=self.peak_pool_pss if have_pss else None,
+                   workers=max_pool, busy_seconds=busy)
+        if self.metrics is not None:
+            self.metrics.close()
+            self.metrics = None
+
+class NullInstrumentation:
+    """No-op stand-in used when BC_INSTRUMENT=off."""
+    interval = math.inf
+
+    def event(self, kind, **fields):
+        pass
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def progress(self, task, total, unit="items", work_total=None, work_unit="pairs", workers=None):
+        return NullProgress()
+
+    def dask_progress(self):
+        return nullcontext()
+
+    def worker(self, stats):
+        pass
+
+    def close(self):
+        pass
+
+_current = None
+
+def current():
+    """Return the process-wide instrumentation, configured from the environment on first use."""
+    global _current
+    if _current is None:
+        if not enabled():
+            _current = NullInstrumentation()
+        else:
+            _current = Instrumentation(metrics_file=os.environ.get("BC_METRICS"),
+                                       interval=float(os.environ.get("BC_PROGRESS_INTERVAL", PROGRESS_INTERVAL)))
+    return _current
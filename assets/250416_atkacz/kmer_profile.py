@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import gzip
+import argparse
+from collections import deque
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import current, worker_stats
+
+# k-mers up to this length are counted exactly (4**k bins); longer ones are hashed
+DENSE_MAX_K = 11
+HASH_BITS = 22
+
+# Bases per batch handed to a worker, and batches in flight per worker
+BATCH_BASES = 4_000_000
+BATCHES_PER_WORKER = 2
+
+# Table rows built and written at a time
+ROWS_PER_CHUNK = 1 << 16
+
+# 2-bit base encoding; anything else (N, IUPAC codes, separators) breaks the k-mer
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for base, code in zip(b"ACGT", range(4)):
+    BASE_CODES[base] = code
+    BASE_CODES[ord(chr(base).lower())] = code
+
+SEPARATOR = b"N"
+
+#############################
+# Streaming reader
+#############################
+
+def read_batches(path, batch_bases=BATCH_BASES, overlap=0):
+    """Yield (batch, fraction_read) from a FASTA or FASTQ file (optionally gzipped).
+    Each batch is one bytes object with reads separated by SEPARATOR, so no
+    k-mer spans two reads. A FASTA record that would overflow the batch is split,
+    and the next piece repeats its last `overlap` (k - 1) bases, so every k-mer is
+    counted once. Memory use is bounded by batch_bases plus one FASTQ read.
+    """
+    total = max(1, os.path.getsize(path))
+    batch, size = [], 0
+    with open(path, "rb") as raw:
+        f = gzip.GzipFile(fileobj=raw) if path.endswith(".gz") else raw
+        first = f.read(1)
+        if first not in (b">", b"@"):
+            sys.exit(f"Error: {path} is neither FASTA nor FASTQ.")
+        fastq = first == b"@"
+        f.seek(0)
+        if fastq:
+            for n, line in enumerate(f):
+                if n % 4 == 1:
+                    seq = line.rstrip()
+                    batch.append(seq)
+                    size += len(seq)
+                    if size >= batch_bases:
+                        yield SEPARATOR.join(batch), raw.tell() / total
+                        batch, size = [], 0
+        else:
+            record, record_size = [], 0
+            for line in f:
+                if line.startswith(b">"):
+                    if record:
+                        batch.append(b"".join(record))
+                        size += record_size
+                        record, record_size = [], 0
+                    if size >= batch_bases:
+                        yield SEPARATOR.join(batch), raw.tell() / total
+                        batch, size = [], 0
+                else:
+                    seq = line.rstrip()
+                    record.append(seq)
+                    record_size += len(seq)
+                    if size + record_size >= batch_bases and record_size > overlap:
+                        # Long record (contig, genome): emit what we have, keep the overlap.
+                        seq = b"".join(record)
+                        batch.append(seq)
+                        yield SEPARATOR.join(batch), raw.tell() / total
+                        batch, size = [], 0
+                        tail = seq[len(seq) - overlap:] if overlap else b""
+                        record, record_size = [tail], len(tail)
+            if record_size:
+                batch.append(b"".join(record))
+    if batch:
+        yield SEPARATOR.join(batch), 1.0
+
+#############################
+# k-mer encoding and counting
+#############################
+
+def kmer_codes(seq, k, canonical):
+    """Return the 2-bit integer codes of all k-mers in seq that contain only A, C, G, T.
+    With canonical=True each k-mer and its reverse complement share one code.
+    """
+    codes = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    n_windows = codes.size - k + 1
+    if n_windows <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    bad = np.concatenate([[0], np.cumsum(codes > 3)])
+    valid = (bad[k:] - bad[:-k]) == 0
+    c = (codes & 3).astype(np.uint64)
+    fwd = np.zeros(n_windows, dtype=np.uint64)
+    for j in range(k):
+        fwd = (fwd << np.uint64(2)) | c[j:j + n_windows]
+    if canonical:
+        rev = np.zeros(n_windows, dtype=np.uint64)
+        for j in range(k):
+            rev |= (np.uint64(3) - c[j:j + n_windows]) << np.uint64(2 * j)
+        fwd = np.minimum(fwd, rev)
+    return fwd[valid]
+
+def bin_codes(codes, k, hash_bits):
+    """Map k-mer codes to accumulator bins: identity for short k, multiplicative hash otherwise."""
+    if k <= DENSE_MAX_K:
+        return codes
+    with np.errstate(over="ignore"):
+        return (codes * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(64 - hash_bits)
+
+def n_bins(k, hash_bits):
+    return 4 ** k if k <= DENSE_MAX_K else 1 << hash_bits
+
+def count_batch(seq, k, canonical, hash_bits):
+    """Count k-mers in one batch. Returns sparse (bins, counts) and worker_stats."""
+    start = time.perf_counter()
+    bins = bin_codes(kmer_codes(seq, k, canonical), k, hash_bits)
+    bins, counts = np.unique(bins, return_counts=True)
+    return bins, counts, worker_stats(start)
+
+def decode_kmer(code, k):
+    return "".join("ACGT"[(code >> (2 * (k - 1 - j))) & 3] for j in range(k))
+
+def bin_names(bins, k):
+    if k <= DENSE_MAX_K:
+        return [decode_kmer(int(b), k) for b in bins]
+    return [f"kmer_bucket_{int(b)}" for b in bins]
+
+def sample_name(path):
+    name = os.path.basename(path)
+    for ext in (".gz", ".fasta", ".fa", ".fna", ".fastq", ".fq"):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name
+
+def profile_file(executor, path, k, canonical, hash_bits, workers):
+    """Stream one read file through the pool and return its sparse k-mer profile
+    (sorted non-empty bins, counts). Only one file's dense accumulator exists at a time.
+    """
+    instr = current()
+    counts = np.zeros(n_bins(k, hash_bits), dtype=np.int64)
+    pending = deque()
+    size_mb = os.path.getsize(path) / 2**20
+    progress = instr.progress(sample_name(path), size_mb, unit="MB", work_unit="k-mers", workers=workers)
+    read_mb = 0.0
+
+    def collect():
+        nonlocal read_mb
+        future, fraction = pending.popleft()
+        bins, c, stats = future.result()
+        counts[bins.astype(np.int64)] += c
+        instr.worker(stats)
+        progress.update(fraction * size_mb - read_mb, work=int(c.sum()))
+        read_mb = fraction * size_mb
+
+    for batch, fraction in read_batches(path, overlap=k - 1):
+        pending.append((executor.submit(count_batch, batch, k, canonical, hash_bits), fraction))
+        if len(pending) >= workers * BATCHES_PER_WORKER:
+            collect()
+    while pending:
+        collect()
+    bins = np.flatnonzero(counts)
+    return bins, counts[bins]
+
+def write_table(path, profiles, names, rows, k):
+    """Write the k-mer table (bins as rows, samples as columns) ROWS_PER_CHUNK rows at a
+    time. profiles are sparse (sorted bins, counts); rows is a sorted array of bins.
+    """
+    with open(path, "w") as f:
+        f.write("\t".join(["#NAME"] + names) + "\n")
+        for r0 in range(0, len(rows), ROWS_PER_CHUNK):
+            chunk = rows[r0:r0 + ROWS_PER_CHUNK]
+            counts = np.zeros((len(chunk), len(profiles)), dtype=np.int64)
+            for s, (bins, c) in enumerate(profiles):
+                lo, hi = np.searchsorted(bins, [chunk[0], chunk[-1] + 1])
+                counts[np.searchsorted(chunk, bins[lo:hi]), s] = c[lo:hi]
+            pd.DataFrame(counts, index=bin_names(chunk, k), columns=names).to_csv(f, sep="\t", header=False)
+
+#############################
+# Main function
+#############################
+def main():
+    parser = argparse.ArgumentParser(description="Count k-mers per read file and write a table for append_braycurtis3.py.")
+    parser.add_argument("reads", nargs="+", help="FASTA/FASTQ files (optionally .gz), one sample per file")
+    parser.add_argument("-k", type=int, default=8, help="k-mer length, at most 32 (default 8)")
+    parser.add_argument("-o", "--output", default="kmer_table.txt", help="output table (default kmer_table.txt)")
+    parser.add_argument("--hash-bits", type=int, default=HASH_BITS,
+                        help=f"log2 of the number of bins when k > {DENSE_MAX_K} (default {HASH_BITS})")
+    parser.add_argument("--no-canonical", action="store_true", help="count k-mers and reverse complements separately")
+    parser.add_argument("--nonzero-bins", action="store_true",
+                        help="write only bins seen in some sample; such tables cannot be appended to "
+                             "one another, since the engine matches rows by position")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count())),
+                        help="worker processes (default SLURM_CPUS_PER_TASK or all CPUs)")
+    args = parser.parse_args()
+    if not 1 <= args.k <= 32:
+        parser.error("k must be between 1 and 32")
+
+    names = [sample_name(path) for path in args.reads]
+    if len(set(names)) != len(names):
+        sys.exit("Error: Read files must have distinct sample names.")
+
+    instr = current()
+    try:
+        run(args, names, instr)
+    finally:
+        instr.close()
+
+def run(args, names, instr):
+    profiles = []
+    with instr.phase("compute"):
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            for path in args.reads:
+                profiles.append(profile_file(executor, path, args.k, not args.no_canonical, args.hash_bits, args.workers))
+
+    with instr.phase("merge"):
+        # Every bin by default, so tables from separate runs have identical rows.
+        if args.nonzero_bins:
+            rows = np.unique(np.concatenate([bins for bins, _ in profiles]))
+        else:
+            rows = np.arange(n_bins(args.k, args.hash_bits))
+    with instr.phase("save"):
+        write_table(args.output, profiles, names, rows, args.k)
+    print(f"k-mer table with {len(rows)} rows and {len(names)} samples saved to {args.output}.", flush=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+from instrumentation import current
+
+# File paths (all stored under the "saved_matrices" folder)
+OUTPUT_FOLDER = "saved_matrices"
+FEATURE_NAMES_FILE = os.path.join(OUTPUT_FOLDER, "feature_names.txt")
+OLD_TABLE_FILE = os.path.join(OUTPUT_FOLDER, "old_asv_table.csv")
+KNN_INDICES_FILE = os.path.join(OUTPUT_FOLDER, "knn_indices.npy")
+KNN_DISTANCES_FILE = os.path.join(OUTPUT_FOLDER, "knn_distances.npy")
+
+# Number of neighbours kept per sample in the saved table
+KNN_K = 10
+
+# Matrix entries per band of rows when selecting neighbours from a large block
+TOPK_BAND_ELEMENTS = 1 << 20
+
+# A small epsilon to avoid division by zero (same as append_braycurtis3.py)
+EPSILON = 1e-12
+
+#############################
+# Top-k table helpers
+#############################
+
+def empty_topk(n, k=KNN_K):
+    """Return an empty neighbour table for n samples.
+    Unused slots hold index -1 and distance +inf.
+    """
+    indices = np.full((n, k), -1, dtype=np.int32)
+    distances = np.full((n, k), np.inf, dtype=np.float32)
+    return indices, distances
+
+def merge_topk(indices, distances, cand_indices, cand_distances):
+    """Merge candidate neighbours into an existing top-k table.
+    indices/distances have shape (n, k); cand_indices/cand_distances have
+    shape (n, c). Returns the new (indices, distances), sorted by distance.
+    """
+    k = indices.shape[1]
+    all_idx = np.concatenate([indices, cand_indices.astype(np.int32, copy=False)], axis=1)
+    all_dist = np.concatenate([distances, cand_distances.astype(np.float32, copy=False)], axis=1)
+    if all_dist.shape[1] > k:
+        part = np.argpartition(all_dist, k - 1, axis=1)[:, :k]
+        all_idx = np.take_along_axis(all_idx, part, axis=1)
+        all_dist = np.take_along_axis(all_dist, part, axis=1)
+    order = np.argsort(all_dist, axis=1, kind="stable")
+    return (np.take_along_axis(all_idx, order, axis=1),
+            np.take_along_axis(all_dist, order, axis=1))
+
+def merge_column(indices, distances, index, column):
+    """Offer sample `index` as a neighbour to every row of an (n, k) table, in place.
+    column[r] is its distance to row r; only rows where it beats the current k-th
+    neighbour are merged.
+    """
+    column = np.asarray(column, dtype=np.float32)
+    rows = np.flatnonzero(column < distances[:, -1])
+    if rows.size:
+        indices[rows], distances[rows] = merge_topk(indices[rows], distances[rows],
+                                                    np.full((rows.size, 1), index, dtype=np.int32),
+                                                    column[rows, None])
+
+def topk_from_block(block, col_offset=0, self_offset=None, k=KNN_K):
+    """Build a top-k table from a dense distance block of shape (rows, cols).
+    Column j of the block is sample col_offset + j. If self_offset is given,
+    row i of the block is sample self_offset + i and is excluded from its own list.
+    Rows are read in bands of about TOPK_BAND_ELEMENTS entries, so block may be a
+    memory map much larger than RAM.
+    """
+    rows, cols = block.shape
+    indices, distances = empty_topk(rows, k)
+    kk = min(k, cols)
+    if kk == 0:
+        return indices, distances
+    step = max(1, TOPK_BAND_ELEMENTS // cols)
+    for r0 in range(0, rows, step):
+        r1 = min(r0 + step, rows)
+        dist = np.array(block[r0:r1], dtype=np.float32)
+        if self_offset is not None:
+            r = np.arange(r1 - r0)
+            c = self_offset + r0 + r - col_offset
+            inside = (c >= 0) & (c < cols)
+            dist[r[inside], c[inside]] = np.inf
+        if kk < cols:
+            part = np.argpartition(dist, kk - 1, axis=1)[:, :kk]
+        else:
+            part = np.broadcast_to(np.arange(cols), dist.shape)
+        d = np.take_along_axis(dist, part, axis=1)
+        order = np.argsort(d, axis=1, kind="stable")
+        band_idx = np.take_along_axis(part, order, axis=1) + col_offset
+        band_dist = np.take_along_axis(d, order, axis=1)
+        # The excluded self entry can only be selected when a row has k or fewer candidates.
+        band_idx[np.isinf(band_dist)] = -1
+        indices[r0:r1, :kk] = band_idx
+        distances[r0:r1, :kk] = band_dist
+    return indices, distances
+
+def load_topk():
+    """Load the saved neighbour table, or return None if it does not exist."""
+    if not (os.path.exists(KNN_INDICES_FILE) and os.path.exists(KNN_DISTANCES_FILE)):
+        return None
+    return np.load(KNN_INDICES_FILE), np.load(KNN_DISTANCES_FILE)
+
+def save_topk(indices, distances):
+    """Save the neighbour table next to the BC matrix."""
+    np.save(KNN_INDICES_FILE, indices.astype(np.int32, copy=False))
+    np.save(KNN_DISTANCES_FILE, distances.astype(np.float32, copy=False))
+
+#############################
+# Queries
+#############################
+
+def load_sample_names():
+    with open(FEATURE_NAMES_FILE, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+def neighbours_of_sample(sample, k):
+    """Return [(name, distance), ...] for a sample already in the matrix."""
+    table = load_topk()
+    if table is None:
+        sys.exit("Error: Neighbour table not found. Run append_braycurtis3.py first.")
+    indices, distances = table
+    names = load_sample_names()
+    try:
+        row = names.index(sample)
+    except ValueError:
+        sys.exit(f"Error: Sample '{sample}' not found in {FEATURE_NAMES_FILE}.")
+    if k > indices.shape[1]:
+        print(f"Only {indices.shape[1]} neighbours are stored; showing those.", flush=True)
+    return [(names[j], float(d)) for j, d in zip(indices[row, :k], distances[row, :k]) if j >= 0]
+
+def braycurtis_to_table(x, old_table):
+    """Bray–Curtis distances between one raw count vector and every column of old_table.
+    x is a pandas Series indexed by ASV; ASVs missing from old_table only add to x's side.
+    """
+    shared = x.index.intersection(old_table.index)
+    extra = float(x.drop(shared).sum())
+    xs = x.loc[shared].to_numpy(dtype=np.float64)
+    Y = old_table.loc[shared].to_numpy(dtype=np.float64)
+    y_rest = old_table.to_numpy(dtype=np.float64).sum(axis=0) - Y.sum(axis=0)
+    num = np.abs(Y - xs[:, None]).sum(axis=0) + y_rest + extra
+    denom = xs.sum() + Y.sum(axis=0) + y_rest + extra
+    d = np.zeros(Y.shape[1], dtype=np.float64)
+    ok = denom >= EPSILON
+    d[ok] = num[ok] / denom[ok]
+    return d
+
+def neighbours_of_table(input_file, k):
+    """Return {new_sample: [(name, distance), ...]} for each column of a raw count table."""
+    if not os.path.exists(OLD_TABLE_FILE):
+        sys.exit(f"Error: {OLD_TABLE_FILE} not found. Run append_braycurtis3.py first.")
+    # Imported here because append_braycurtis3 imports this module.
+    from append_braycurtis3 import load_new_table
+    old_table = pd.read_csv(OLD_TABLE_FILE, index_col=0)
+    # Same loading (and NaN-column dropping) as the exact engine.
+    new_table = load_new_table(input_file)
+    names = list(old_table.columns)
+    results = {}
+    for col in new_table.columns:
+        d = braycurtis_to_table(new_table[col], old_table)
+        order = np.argsort(d, kind="stable")[:k]
+        results[col] = [(names[j], float(d[j])) for j in order]
+    return results
+
+#############################
+# Main function
+#############################
+def main():
+    parser = argparse.ArgumentParser(description="Query the k nearest samples by Bray–Curtis distance.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--sample", help="sample ID already present in feature_names.txt")
+    group.add_argument("--table", help="tab-separated raw count table (ASVs as rows, samples as columns)")
+    parser.add_argument("-k", type=int, default=KNN_K, help=f"number of neighbours (default {KNN_K})")
+    args = parser.parse_args()
+
+    # Table queries load through append_braycurtis3, which reports to the instrumentation.
+    instr = current()
+    try:
+        run(args)
+    finally:
+        instr.close()
+
+def run(args):
+    if args.sample is not None:
+        results = {args.sample: neighbours_of_sample(args.sample, args.k)}
+    else:
+        results = neighbours_of_table(args.table, args.k)
+
+    for query, neighbours in results.items():
+        print(f"Nearest samples to {query}:", flush=True)
+        for rank, (name, d) in enumerate(neighbours, start=1):
+            print(f"{rank}\t{name}\t{d:.6f}", flush=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import hashlib
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from append_braycurtis3 import MAX_WORKERS, load_new_table
+from instrumentation import current, worker_stats
+from knn_neighbours import KNN_K, empty_topk, topk_from_block
+
+# File paths (all stored under the "saved_matrices" folder)
+OUTPUT_FOLDER = "saved_matrices"
+os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+MATRIX_FILE = os.path.join(OUTPUT_FOLDER, "braycurtis_matrix_columns.npy")
+FEATURE_NAMES_FILE = os.path.join(OUTPUT_FOLDER, "feature_names.txt")
+SKETCH_FILE = os.path.join(OUTPUT_FOLDER, "icws_sketches.npz")
+APPROX_MATRIX_FILE = os.path.join(OUTPUT_FOLDER, "braycurtis_matrix_approx.npy")
+APPROX_KNN_INDICES_FILE = os.path.join(OUTPUT_FOLDER, "knn_indices_approx.npy")
+APPROX_KNN_DISTANCES_FILE = os.path.join(OUTPUT_FOLDER, "knn_distances_approx.npy")
+
+# Sketch size (hashes per sample) and seed. All sketches in one file must share both.
+NUM_HASHES = 256
+SKETCH_SEED = 20250416
+
+# Failure probability used for the per-pair error bound
+DELTA = 0.01
+
+# Upper limit on the number of hash comparisons held in memory at once
+BLOCK_ELEMENTS = 1 << 26
+
+#############################
+# Improved Consistent Weighted Sampling (Ioffe, 2010)
+#############################
+# For raw counts x, y the ICWS collision probability equals the weighted Jaccard
+# similarity J = sum(min) / sum(max). Since sum(min) + sum(max) = sum(x + y),
+# Bray–Curtis is exactly BC = (1 - J) / (1 + J), so it is estimated from the
+# fraction of matching hashes.
+
+def feature_hash(name):
+    """Stable 64-bit hash of an ASV name, independent of its row position."""
+    return int.from_bytes(hashlib.blake2b(str(name).encode(), digest_size=8).digest(), "little")
+
+def feature_randoms(names, num_hashes, seed):
+    """Draw the ICWS variables (r, c, beta) for each ASV.
+    They are seeded by the ASV name, so tables with different rows share them.
+    """
+    F = len(names)
+    hashes = np.empty(F, dtype=np.uint64)
+    r = np.empty((F, num_hashes))
+    c = np.empty((F, num_hashes))
+    beta = np.empty((F, num_hashes))
+    for f, name in enumerate(names):
+        h = feature_hash(name)
+        rng = np.random.default_rng([seed, h])
+        hashes[f] = h
+        r[f] = rng.gamma(2.0, 1.0, num_hashes)
+        c[f] = rng.gamma(2.0, 1.0, num_hashes)
+        beta[f] = rng.uniform(0.0, 1.0, num_hashes)
+    return hashes, r, c, beta
+
+def mix(h, t):
+    """Combine an ASV hash and the ICWS t value into one nonzero 64-bit signature."""
+    with np.errstate(over="ignore"):
+        z = h ^ (t.astype(np.int64).view(np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return z | np.uint64(1)
+
+# Global variables for sketch workers.
+values_global = None
+randoms_global = None
+
+def init_worker_sketch(values, randoms):
+    """Initializer for workers sketching table columns."""
+    global values_global, randoms_global
+    values_global = values
+    randoms_global = randoms
+
+def sketch_col(i):
+    """Compute the ICWS sketch of column i. An all-zero column gets an all-zero sketch.
+    Returns (i, sketch, worker_stats) where sketch is a uint64 array of length NUM_HASHES.
+    """
+    start = time.perf_counter()
+    hashes, r, c, beta = randoms_global
+    x = values_global[:, i]
+    nz = np.flatnonzero(x > 0)
+    if nz.size == 0:
+        return i, np.zeros(r.shape[1], dtype=np.uint64), worker_stats(start)
+    ln_s = np.log(x[nz])[:, None]
+    r_nz = r[nz]
+    beta_nz = beta[nz]
+    t = np.floor(ln_s / r_nz + beta_nz)
+    ln_a = np.log(c[nz]) - r_nz * (t - beta_nz) - r_nz
+    kstar = np.argmin(ln_a, axis=0)
+    cols = np.arange(r.shape[1])
+    return i, mix(hashes[nz][kstar], t[kstar, cols]), worker_stats(start)
+
+#############################
+# Sketch storage
+#############################
+
+def load_sketches():
+    """Return (sketches, names, seed) or None if no sketches are saved."""
+    if not os.path.exists(SKETCH_FILE):
+        return None
+    data = np.load(SKETCH_FILE)
+    return data["sketches"], list(data["names"]), int(data["seed"])
+
+def save_sketches(sketches, names, seed):
+    np.savez(SKETCH_FILE, sketches=sketches, names=np.array(names), seed=seed)
+
+def append_table(input_file, num_hashes):
+    """Sketch every column of input_file and append the rows to the saved sketches."""
+    saved = load_sketches()
+    if saved is not None:
+        old_sketches, old_names, seed = saved
+        if old_sketches.shape[1] != num_hashes:
+            print(f"Saved sketches use {old_sketches.shape[1]} hashes; using that instead of {num_hashes}.", flush=True)
+            num_hashes = old_sketches.shape[1]
+    else:
+        old_sketches = np.zeros((0, num_hashes), dtype=np.uint64)
+        old_names, seed = [], SKETCH_SEED
+
+    instr = current()
+    with instr.phase("load"):
+        new_table = load_new_table(input_file)
+    new_names = [str(col) for col in new_table.columns]
+    duplicates = set(old_names).intersection(new_names)
+    if duplicates:
+        sys.exit(f"Error: Samples already sketched: {sorted(duplicates)[:5]}")
+    m = len(new_names)
+    values = new_table.to_numpy(dtype=np.float64)
+
+    with instr.phase("compute sketches"):
+        randoms = feature_randoms(list(new_table.index), num_hashes, seed)
+        new_sketches = np.zeros((m, num_hashes), dtype=np.uint64)
+        progress = instr.progress("sketches", m, unit="features", workers=min(MAX_WORKERS, m))
+        with ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=init_worker_sketch, initargs=(values, randoms)) as executor:
+            for i, sketch, stats in executor.map(sketch_col, range(m)):
+                new_sketches[i] = sketch
+                instr.worker(stats)
+                progress.update()
+
+    with instr.phase("save"):
+        save_sketches(np.vstack([old_sketches, new_sketches]), old_names + new_names, seed)
+    print(f"Sketches saved: {len(old_names) + m} samples, {num_hashes} hashes each.", flush=True)
+
+#############################
+# Approximate distances
+#############################
+
+def error_bound(num_hashes, delta=DELTA):
+    """Bray–Curtis error that a single pair exceeds with probability at most delta.
+    Hoeffding gives |J_hat - J| <= sqrt(ln(2/delta) / (2D)) and |dBC/dJ| <= 2.
+    """
+    return 2.0 * np.sqrt(np.log(2.0 / delta) / (2.0 * num_hashes))
+
+def approx_block(A, B):
+    """Approximate Bray–Curtis distances between sketch rows A (a, D) and B (b, D)."""
+    J = (A[:, None, :] == B[None, :, :]).mean(axis=2)
+    d = (1.0 - J) / (1.0 + J)
+    a_empty = ~A.any(axis=1)
+    b_empty = ~B.any(axis=1)
+    d[a_empty[:, None] != b_empty[None, :]] = 1.0
+    d[a_empty[:, None] & b_empty[None, :]] = 0.0
+    return d.astype(np.float32)
+
+def row_blocks(n, num_hashes):
+    step = max(1, BLOCK_ELEMENTS // max(1, n * num_hashes))
+    for start in range(0, n, step):
+        yield start, min(start + step, n)
+
+def approx_matrix(sketches):
+    n = sketches.shape[0]
+    M = np.zeros((n, n), dtype=np.float32)
+    progress = current().progress("approximate distances", n, unit="rows", work_total=n * n)
+    for start, stop in row_blocks(n, sketches.shape[1]):
+        M[start:stop] = approx_block(sketches[start:stop], sketches)
+        progress.update(stop - start, work=(stop - start) * n)
+    np.fill_diagonal(M, 0)
+    return M
+
+def approx_neighbours(sketches, k):
+    n = sketches.shape[0]
+    indices, distances = empty_topk(n, k)
+    progress = current().progress("approximate neighbours", n, unit="rows", work_total=n * n)
+    for start, stop in row_blocks(n, sketches.shape[1]):
+        block = approx_block(sketches[start:stop], sketches)
+        indices[start:stop], distances[start:stop] = topk_from_block(block, col_offset=0, self_offset=start, k=k)
+        progress.update(stop - start, work=(stop - start) * n)
+    return indices, distances
+
+def check_against_exact(sketches, names):
+    """Compare approximate distances with the exact BC matrix for samples present in both."""
+    if not (os.path.exists(MATRIX_FILE) and os.path.exists(FEATURE_NAMES_FILE)):
+        sys.exit("Error: Exact BC matrix not found. Run append_braycurtis3.py first.")
+    exact = np.load(MATRIX_FILE, mmap_mode="r")
+    with open(FEATURE_NAMES_FILE, "r") as f:
+        exact_names = [line.strip() for line in f if line.strip()]
+    position = {name: j for j, name in enumerate(exact_names)}
+    rows = [i for i, name in enumerate(names) if name in position]
+    if len(rows) < 2:
+        sys.exit("Error: Fewer than two samples are both sketched and in the exact matrix.")
+    cols = np.array([position[names[i]] for i in rows])
+    approx = approx_matrix(sketches[rows])
+    iu = np.triu_indices(len(rows), k=1)
+    err = np.abs(approx[iu] - np.asarray(exact)[np.ix_(cols, cols)][iu])
+    bound = error_bound(sketches.shape[1])
+    print(f"Compared {len(rows)} samples ({err.size} pairs) with {sketches.shape[1]} hashes.", flush=True)
+    print(f"Mean absolute error: {err.mean():.4f}", flush=True)
+    print(f"Max absolute error:  {err.max():.4f}", flush=True)
+    print(f"Bound at delta={DELTA}: {bound:.4f}; pairs above bound: {np.mean(err > bound):.2%}", flush=True)
+
+#############################
+# Main function
+#############################
+def main():
+    parser = argparse.ArgumentParser(description="Approximate Bray–Curtis distances from weighted MinHash (ICWS) sketches.")
+    parser.add_argument("table", nargs="?", help="tab-separated count table to sketch and append")
+    parser.add_argument("--num-hashes", type=int, default=NUM_HASHES,
+                        help=f"hashes per sample for a new sketch file (default {NUM_HASHES})")
+    parser.add_argument("--matrix", action="store_true", help="write the approximate n x n distance matrix")
+    parser.add_argument("--neighbours", type=int, nargs="?", const=KNN_K, metavar="K",
+                        help=f"write approximate top-K neighbour lists (default K={KNN_K})")
+    parser.add_argument("--check", action="store_true", help="compare against the exact BC matrix")
+    args = parser.parse_args()
+    if args.table is None and not (args.matrix or args.neighbours or args.check):
+        parser.error("nothing to do: give a table and/or --matrix, --neighbours, --check")
+    instr = current()
+    try:
+        run(args, instr)
+    finally:
+        instr.close()
+
+def run(args, instr):
+    if args.table is not None:
+        append_table(args.table, args.num_hashes)
+
+    saved = load_sketches()
+    if saved is None:
+        sys.exit(f"Error: No sketches found in {SKETCH_FILE}.")
+    sketches, names, _ = saved
+    print(f"Approximation error bound per pair: {error_bound(sketches.shape[1]):.4f} "
+          f"(probability {1 - DELTA:.0%})", flush=True)
+
+    if args.matrix:
+        with instr.phase("compute approximate matrix"):
+            M = approx_matrix(sketches)
+        with instr.phase("save"):
+            np.save(APPROX_MATRIX_FILE, M)
+        print(f"Approximate BC matrix saved to {APPROX_MATRIX_FILE} (rows follow the names stored in the sketch file).", flush=True)
+    if args.neighbours:
+        with instr.phase("compute approximate neighbours"):
+            indices, distances = approx_neighbours(sketches, args.neighbours)
+        with instr.phase("save"):
+            np.save(APPROX_KNN_INDICES_FILE, indices)
+            np.save(APPROX_KNN_DISTANCES_FILE, distances)
+        print("Approximate neighbour table saved.", flush=True)
+    if args.check:
+        with instr.phase("check"):
+            check_against_exact(sketches, names)
+
+if __name__ == '__main__':
+    main()